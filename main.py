@@ -1,12 +1,36 @@
+import asyncio
+import logging
+import os
 import re
-from typing import List, Tuple, Optional, Literal
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from operator import attrgetter
+from typing import List, NamedTuple, Tuple, Optional, Literal
 
 import httpx
+import orjson
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Long-lived clients so connections are pooled and kept alive between requests
+    app.state.ollama = httpx.AsyncClient(base_url="http://localhost:11434", timeout=30)
+    app.state.store = httpx.AsyncClient(base_url="https://fakestoreapi.com", timeout=15)
+    try:
+        await warm_up()
+        yield
+    finally:
+        await app.state.ollama.aclose()
+        await app.state.store.aclose()
+
+logger = logging.getLogger("uvicorn.error")
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
@@ -58,6 +82,15 @@ CATEGORY_SYNONYMS = {
 VALID_CATEGORIES = {"men's clothing", "women's clothing", "jewelery", "electronics"}
 ALLOWED_SORT = {"relevance", "price_asc", "price_desc", "rating_desc"} # To prevent crash when try to sort invalid values
 
+# Compiled once at import; used on every request
+_BETWEEN_RE = re.compile(r"(?:between|from)\s*\$?\s*(\d+(?:\.\d+)?)\s*(?:and|to|-)\s*\$?\s*(\d+(?:\.\d+)?)")
+_UNDER_RE = re.compile(r"(?:under|below|less than|max(?:imum)?|<=|<)\s*\$?\s*(\d+(?:\.\d+)?)")
+_OVER_RE = re.compile(r"(?:over|above|more than|min(?:imum)?|at least|>=|>)\s*\$?\s*(\d+(?:\.\d+)?)")
+_JSON_BLOB_RE = re.compile(r"\{[\s\S]*\}")  # fallback when model wraps JSON in extra text
+# Group names are the sort values they map to
+_SORT_PHRASES_RE = re.compile(r"(?P<rating_desc>good review|best rated|high rating)|(?P<price_asc>cheap)|(?P<price_desc>expensive)")
+_SORT_PHRASE_PRIORITY = ("rating_desc", "price_asc", "price_desc")
+
 # To prevent crash when try to sort invalid values
 def sanitize_sort_by(value: Optional[str]) -> str:
     if not value:
@@ -65,90 +98,136 @@ def sanitize_sort_by(value: Optional[str]) -> str:
     v = value.lower().strip()
     if v in ALLOWED_SORT:
         return v
-    # Map common phrases to allowed sorts
-    if "good review" in v or "best rated" in v or "high rating" in v:
-        return "rating_desc"
-    if "cheap" in v:
-        return "price_asc"
-    if "expensive" in v:
-        return "price_desc"
+    # Map common phrases to allowed sorts, one scan; rating phrases win over price ones
+    hits = {m.lastgroup for m in _SORT_PHRASES_RE.finditer(v)}
+    for sort in _SORT_PHRASE_PRIORITY:
+        if sort in hits:
+            return sort
     return "relevance"
 
 
+# Valid names map to themselves, synonyms to their target (or None); one lookup per category.
+# Targets are interned so category comparisons in apply_filters hit the identity fast path.
+_CAT_MAP = {
+    k: (sys.intern(v) if v else None)
+    for k, v in {**{c: c for c in VALID_CATEGORIES}, **CATEGORY_SYNONYMS}.items()
+}
+
 def normalize_categories(cats: List[str]) -> List[str]:
-    out = set()
-    for c in cats:
-        lc = c.lower().strip()
-        mapped = CATEGORY_SYNONYMS.get(lc, lc if lc in VALID_CATEGORIES else None)
-        if mapped:
-            out.add(mapped)
-    return sorted(out) #["Men", "jewelry"] -> ["jewelery", "men's clothing"]
-
-async def fetch_products() -> List[Product]:
-    async with httpx.AsyncClient(timeout=15) as client:
-        r = await client.get("https://fakestoreapi.com/products")
+    return sorted({m for c in cats if (m := _CAT_MAP.get(c.lower().strip()))}) #["Men", "jewelry"] -> ["jewelery", "men's clothing"]
+
+class Catalog(NamedTuple):
+    # Per-product fields precomputed once per fetch, index-aligned with products
+    products: List[Product]
+    haystacks: List[str]   # lowercased "title description category"
+    categories: List[str]  # lowercased category
+    rates: List[float]     # rating["rate"], 0 when missing
+    by_price: List[int]    # product indices ordered by price (stable)
+    sorted_prices: List[float]  # prices in by_price order, for bisect
+
+def build_catalog(products: List[Product]) -> Catalog:
+    by_price = sorted(range(len(products)), key=lambda i: products[i].price)
+    return Catalog(
+        products=products,
+        haystacks=[f"{p.title} {p.description} {p.category}".lower() for p in products],
+        categories=[sys.intern(p.category.lower()) for p in products],
+        rates=[float((p.rating or {}).get("rate", 0)) for p in products],
+        by_price=by_price,
+        sorted_prices=[products[i].price for i in by_price],
+    )
+
+# FakeStore catalog is static enough to keep in-process for CATALOG_TTL seconds
+CATALOG_TTL = int(os.getenv("CATALOG_TTL", "120"))
+_CATALOG_CACHE: Optional[Tuple[float, Catalog]] = None
+_CATALOG_LOCK = asyncio.Lock()  # concurrent misses wait for a single fetch
+_PRODUCT_LIST = TypeAdapter(List[Product])  # validates the whole payload in one call
+
+async def fetch_products() -> Catalog:
+    global _CATALOG_CACHE
+    cached = _CATALOG_CACHE
+    if cached is not None and time.monotonic() - cached[0] < CATALOG_TTL:
+        return cached[1]
+
+    async with _CATALOG_LOCK:
+        # Another request may have refreshed the cache while we waited
+        cached = _CATALOG_CACHE
+        if cached is not None and time.monotonic() - cached[0] < CATALOG_TTL:
+            return cached[1]
+
+        r = await app.state.store.get("/products")
         r.raise_for_status()
-        data = r.json()
-        return [Product(**p) for p in data]
-
-def apply_filters(products: List[Product], f: Filters) -> List[Product]:
-    out = products[:]
-
-    # Price window
-    if f.price_min is not None:
-        out = [p for p in out if p.price >= f.price_min]
-    if f.price_max is not None:
-        out = [p for p in out if p.price <= f.price_max]
-
-    # rating threshold 
-    if f.rating_min is not None:
-        out = [p for p in out if (p.rating or {}).get("rate", 0) >= f.rating_min]
-
-    # Category filter
-    if f.categories:
-        cats = {c.lower() for c in f.categories}
-        out = [p for p in out if p.category.lower() in cats]
-
-    # Keywords, title, description, category
-    if f.keywords:
-        kws = [k.lower() for k in f.keywords]
-        def haystack(p: Product):
-            return f"{p.title} {p.description} {p.category}".lower()
-        out = [p for p in out if all(k in haystack(p) for k in kws)]
-
+        data = orjson.loads(r.content)
+        catalog = build_catalog(_PRODUCT_LIST.validate_python(data))
+        _CATALOG_CACHE = (time.monotonic(), catalog)
+        return catalog
+
+def apply_filters(catalog: Catalog, f: Filters) -> List[Product]:
+    pmin, pmax, rmin = f.price_min, f.price_max, f.rating_min
+    cats = {sys.intern(c.lower()) for c in f.categories} or None
+    kws = [k.lower() for k in f.keywords]
+
+    # Price window via binary search on the price-sorted index; the remaining
+    # candidates are put back in catalog order so "relevance" is unchanged
+    if pmin is None and pmax is None:
+        idx = range(len(catalog.products))
+    else:
+        lo = 0 if pmin is None else bisect_left(catalog.sorted_prices, pmin)
+        hi = len(catalog.sorted_prices) if pmax is None else bisect_right(catalog.sorted_prices, pmax)
+        idx = sorted(catalog.by_price[lo:hi])
+
+    # Single pass over the candidates: rating threshold, category,
+    # keywords (ALL must appear in title/description/category)
+    products, haystacks, categories, rates = catalog.products, catalog.haystacks, catalog.categories, catalog.rates
+    keep = [
+        i for i in idx
+        if (rmin is None or rates[i] >= rmin)
+        and (cats is None or categories[i] in cats)
+        and (not kws or all(k in haystacks[i] for k in kws))
+    ]
+
+    # Sorts are stable, so ties keep catalog order
+    if f.sort_by == "rating_desc":
+        keep.sort(key=rates.__getitem__, reverse=True)
+    out = [products[i] for i in keep]
     if f.sort_by == "price_asc":
-        out.sort(key=lambda p: p.price)
+        out.sort(key=attrgetter("price"))
     elif f.sort_by == "price_desc":
-        out.sort(key=lambda p: -p.price)
-    elif f.sort_by == "rating_desc":
-        out.sort(key=lambda p: -float((p.rating or {}).get("rate", 0)))
+        out.sort(key=attrgetter("price"), reverse=True)
     # relevance -> leave order as is
 
     return out
 
+# LRU of parsed filters keyed on the normalized query, so repeats skip Ollama
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1024"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
+_LLM_CACHE: "OrderedDict[str, Tuple[float, Filters]]" = OrderedDict()
+
 async def call_mistral(query: str) -> Filters:
-#     SYSTEM = """You convert shopping queries into strict JSON filters for a product search engine.
-# Return ONLY valid JSON with this schema and no extra text:
-
-# {
-#   "categories": string[],
-#   "keywords": string[],
-#   "price_min": number|null,
-#   "price_max": number|null,
-#   "rating_min": number|null,
-#   "sort_by": "relevance" | "price_asc" | "price_desc" | "rating_desc"
-# }
-
-# Rules:
-# - If user says "under/below", set price_max; "above/over" -> price_min.
-# - "good reviews" => rating_min = 4; "excellent/4.5+" => rating_min = 4.5.
-# - Extract concrete product-type words as keywords (e.g., "running shoes" -> ["running","shoes"]).
-# - Use sort_by if the user implies it: "cheapest" -> price_asc, "best rated" -> rating_desc.
-# - If unknown, leave null/empty but output valid JSON only.
-# """
-
-
-    SYSTEM = """You convert shopping queries into strict JSON filters for a product search engine.
+    key = " ".join(query.lower().split())
+    hit = _LLM_CACHE.get(key)
+    if hit is not None and time.monotonic() - hit[0] < LLM_CACHE_TTL:
+        _LLM_CACHE.move_to_end(key)
+        return hit[1].model_copy(deep=True)  # callers adjust filters in place
+
+    f = await _ask_mistral(key)
+    _LLM_CACHE[key] = (time.monotonic(), f)
+    _LLM_CACHE.move_to_end(key)
+    while len(_LLM_CACHE) > LLM_CACHE_SIZE:
+        _LLM_CACHE.popitem(last=False)
+    return f.model_copy(deep=True)
+
+_JSON_HEADERS = {"content-type": "application/json"}
+
+# Shared by real requests and the startup ping; Ollama reloads the runner when num_ctx changes
+_OLLAMA_OPTIONS = {
+    "temperature": 0.1, # more deterministic
+    "top_k": 10,
+    "num_predict": 128, # a filled-in schema is well under 100 tokens
+    "num_ctx": 1024, # prompt is ~450 tokens
+}
+
+# Built once at import; sent as the prefix of every Ollama prompt
+SYSTEM_PROMPT = """You convert shopping queries into strict JSON filters for a product search engine.
 Return ONLY JSON with this exact schema:
 
 {
@@ -174,9 +253,6 @@ Other rules:
 - If unknown, leave fields null/empty, but always return valid JSON.
 
 Examples:
-Q: "electronics under $100"
-A: {"categories":["electronics"],"keywords":[],"price_min":null,"price_max":100,"rating_min":null,"sort_by":"relevance"}
-
 Q: "electronics over $100"
 A: {"categories":["electronics"],"keywords":[],"price_min":100,"price_max":null,"rating_min":null,"sort_by":"relevance"}
 
@@ -184,34 +260,51 @@ Q: "women's clothing between $20 and $50 with 4+ stars"
 A: {"categories":["women's clothing"],"keywords":[],"price_min":20,"price_max":50,"rating_min":4,"sort_by":"relevance"}
 """
 
+async def _ask_mistral(query: str) -> Filters:
     PROMPT = f'User query: """{query}"""\nReturn JSON now:'
 
     body = {
         "model": "mistral",
-        "prompt": f"{SYSTEM}\n\n{PROMPT}",
-        "stream": False,
-        "options": {"temperature": 0.1}, # more deterministic
+        "prompt": f"{SYSTEM_PROMPT}\n\n{PROMPT}",
+        "stream": True,
+        "options": _OLLAMA_OPTIONS,
         "format": "json"
     }
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post("http://localhost:11434/api/generate", json=body)
+    # Stream tokens and stop reading as soon as they form a complete JSON object;
+    # closing the stream early makes Ollama stop generating the trailing padding
+    parsed = None
+    pieces: List[str] = []
+    async with app.state.ollama.stream("POST", "/api/generate", content=orjson.dumps(body), headers=_JSON_HEADERS) as r:
         if r.status_code != 200:
+            await r.aread()
             raise HTTPException(status_code=502, detail=f"Ollama error: {r.text}")
 
-        data = r.json()  # {"response": "...", ...}
-        text = data.get("response", "")
-
-    # Parse JSON from model output
-    try:
-        import json
-        parsed = json.loads(text)
-    except Exception:
-        m = re.search(r"\{[\s\S]*\}", text)
+        async for line in r.aiter_lines():
+            if not line:
+                continue
+            chunk = orjson.loads(line)  # {"response": "...", "done": bool, ...}
+            if "error" in chunk:
+                # Failures after the stream has started arrive as {"error": "..."} with HTTP 200
+                raise HTTPException(status_code=502, detail=f"Ollama error: {chunk['error']}")
+            piece = chunk.get("response", "")
+            pieces.append(piece)
+            if "}" in piece:
+                try:
+                    parsed = orjson.loads("".join(pieces))
+                    break
+                except orjson.JSONDecodeError:
+                    pass
+            if chunk.get("done"):
+                break
+
+    # Parse JSON from model output if the stream ended without a clean object
+    if parsed is None:
+        text = "".join(pieces)
+        m = _JSON_BLOB_RE.search(text)
         if not m:
             raise HTTPException(status_code=500, detail="Model returned non-JSON.")
-        import json
-        parsed = json.loads(m.group(0))
+        parsed = orjson.loads(m.group(0))
 
     # Validation & normalization
     parsed["sort_by"] = sanitize_sort_by(parsed.get("sort_by")) # so Pydantic won’t explode
@@ -223,25 +316,91 @@ A: {"categories":["women's clothing"],"keywords":[],"price_min":20,"price_max":5
 def extract_price_constraints(q: str) -> Tuple[Optional[float], Optional[float]]:
     text = q.lower().replace(",", "")
     # between $A and $B / $A-$B
-    m = re.search(rf"(?:between|from)\s*\$?\s*(\d+(?:\.\d+)?)\s*(?:and|to|-)\s*\$?\s*(\d+(?:\.\d+)?)", text)
+    m = _BETWEEN_RE.search(text)
     if m:
         a, b = float(m.group(1)), float(m.group(2))
         lo, hi = (a, b) if a <= b else (b, a)
         return lo, hi
 
     # under/below/less than/max/<=
-    m = re.search(rf"(?:under|below|less than|max(?:imum)?|<=|<)\s*\$?\s*(\d+(?:\.\d+)?)", text)
+    m = _UNDER_RE.search(text)
     if m:
         return None, float(m.group(1))
 
     # over/above/more than/min/>=/>
-    m = re.search(rf"(?:over|above|more than|min(?:imum)?|at least|>=|>)\s*\$?\s*(\d+(?:\.\d+)?)", text)
+    m = _OVER_RE.search(text)
     if m:
         return float(m.group(1)), None
 
     return None, None
 
 
+# Words a simple query may contain besides categories, prices and sort hints
+_SIMPLE_FILLER = {
+    "show", "me", "find", "get", "i", "want", "need", "looking", "for", "search",
+    "some", "any", "all", "the", "a", "an", "in", "of", "with", "and", "or", "that", "are", "is",
+    "items", "products", "stuff", "things", "please", "priced", "price", "cost", "costs",
+    "dollars", "usd", "$",
+}
+_CATEGORY_TERM_RE = re.compile(
+    r"\b(?:" + "|".join(
+        re.escape(t) for t in sorted(
+            VALID_CATEGORIES | {k for k, v in CATEGORY_SYNONYMS.items() if v},
+            key=len, reverse=True,
+        )
+    ) + r")\b"
+)
+_SORT_HINT_RE = re.compile(r"\b(?:cheap(?:est)?|(?:most )?expensive|best rated|good reviews?|high rating)\b")
+
+# Fast path: "<category> <price-op> $N" style queries are resolved without the LLM.
+# Returns None (-> call_mistral) as soon as the query has anything we can't account for.
+def try_parse_simple(q: str) -> Optional[Filters]:
+    text = q.lower().replace(",", "")
+
+    price_hits = 0
+    for rx in (_BETWEEN_RE, _UNDER_RE, _OVER_RE):
+        text, n = rx.subn(" ", text)
+        price_hits += n
+    if price_hits > 1:
+        return None
+
+    cats = _CATEGORY_TERM_RE.findall(text)
+    text = _CATEGORY_TERM_RE.sub(" ", text)
+    sorts = _SORT_HINT_RE.findall(text)
+    text = _SORT_HINT_RE.sub(" ", text)
+    if len(sorts) > 1 or not (price_hits or cats or sorts):
+        return None
+
+    # Anything left must be filler; leftover words could be keywords, numbers could be ratings
+    if any(w and w not in _SIMPLE_FILLER for w in (tok.strip(".!?") for tok in text.split())):
+        return None
+
+    pmin, pmax = extract_price_constraints(q)
+    return Filters(
+        categories=normalize_categories(cats),
+        price_min=pmin,
+        price_max=pmax,
+        sort_by=sanitize_sort_by(sorts[0]) if sorts else "relevance",
+    )
+
+
+# Pay cold-start costs at startup instead of on the first user request:
+# Ollama loading the model, the FakeStore handshake and catalog validation.
+# Failures are only logged; requests will retry them as usual.
+async def warm_up() -> None:
+    ping = {"model": "mistral", "prompt": "ping", "stream": False, "options": {**_OLLAMA_OPTIONS, "num_predict": 1}}
+    results = await asyncio.gather(
+        app.state.ollama.post("/api/generate", content=orjson.dumps(ping), headers=_JSON_HEADERS),
+        fetch_products(),
+        return_exceptions=True,
+    )
+    for what, res in zip(("Ollama", "FakeStore catalog"), results):
+        if isinstance(res, Exception):
+            logger.warning("Warm-up of %s failed: %r", what, res)
+        elif isinstance(res, httpx.Response) and res.is_error:
+            logger.warning("Warm-up of %s failed: HTTP %s %s", what, res.status_code, res.text)
+
+
 # ---------- API ----------
 @app.post("/nlp-search", response_model=SearchResponse)
 async def nlp_search(req: SearchRequest):
@@ -249,7 +408,12 @@ async def nlp_search(req: SearchRequest):
     if not q:
         raise HTTPException(status_code=400, detail="Missing query")
 
-    filters = await call_mistral(q)
+    filters = try_parse_simple(q)
+    if filters is None:
+        # LLM parse and catalog fetch are independent, run them concurrently
+        filters, catalog = await asyncio.gather(call_mistral(q), fetch_products())
+    else:
+        catalog = await fetch_products()
 
     # Hardening price logic based on the literal query
     pmin, pmax = extract_price_constraints(q)
@@ -267,6 +431,5 @@ async def nlp_search(req: SearchRequest):
     if (filters.price_min is not None and filters.price_max is not None and filters.price_min > filters.price_max):
         filters.price_min, filters.price_max = filters.price_max, filters.price_min
 
-    products = await fetch_products()
-    results = apply_filters(products, filters)
+    results = apply_filters(catalog, filters)
     return SearchResponse(filters=filters, count=len(results), results=results)